@@ -9,4 +9,10 @@ import scrapy
 class BookCrawlerItem(scrapy.Item):
     # define the fields for your item here like:
     # name = scrapy.Field()
-    pass
\ No newline at end of file
+    pass
+
+
+class TagItem(scrapy.Item):
+    url = scrapy.Field()
+    position = scrapy.Field()
+    css_path = scrapy.Field()
\ No newline at end of file
@@ -1,76 +1,126 @@
 import scrapy
-from collections import defaultdict
+from scrapy.spidermiddlewares.httperror import HttpError
+from dataclasses import dataclass, field
 import os
 from dotenv import load_dotenv
 import urllib.parse
 import re
+from lxml import etree
+from w3lib.url import canonicalize_url
+
+from book_crawler.items import TagItem
 
 
 load_dotenv()
 
+SKIPPED_TAGS = {'script', 'style'}
+
+
+def first_text(elem):
+    """Return the first non-empty text node of elem, like XPath text()"""
+    if elem.text:
+        return elem.text
+    for child in elem:
+        if child.tail:
+            return child.tail
+    return None
+
+
+@dataclass(slots=True)
+class SiteRecord:
+    position: int
+    status: int | None = None
+    css_paths: set = field(default_factory=set)
+
 
 class KeywordTagSpider(scrapy.Spider):
     name = 'keyword_tags_cse'
     custom_settings = {
         'DOWNLOAD_TIMEOUT': 15,
-        'RETRY_TIMES': 2,
-        'CONCURRENT_REQUESTS': 8,
-        'CONCURRENT_REQUESTS_PER_DOMAIN': 2,
+        'RETRY_TIMES': 1,
+        'RETRY_HTTP_CODES': [500, 502, 503, 504, 408, 429],
+        'DOWNLOAD_MAXSIZE': 5 * 1024 * 1024,
+        'CONCURRENT_REQUESTS': 64,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 4,
+        'REACTOR_THREADPOOL_MAXSIZE': 32,
         'ROBOTSTXT_OBEY': False,
-        'DOWNLOAD_DELAY': 0.5,
+        'DOWNLOAD_DELAY': 0,
+        'AUTOTHROTTLE_ENABLED': True,
+        'AUTOTHROTTLE_START_DELAY': 0.1,
+        'AUTOTHROTTLE_MAX_DELAY': 5,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 8.0,
         'LOG_LEVEL': 'INFO',
         'FEED_EXPORT_ENCODING': 'utf-8',
+        'FEEDS': {
+            'css_paths.jsonl.gz': {
+                'format': 'jsonlines',
+                'encoding': 'utf-8',
+                'overwrite': True,
+                'postprocessing': ['scrapy.extensions.postprocessing.GzipPlugin'],
+            },
+        },
     }
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.INDUSTRY_MODULE = 'solar_energy'
         self.KEYWORD = 'solar panel market analysis'
+        keywords = self.KEYWORD.lower().split()
+        self._kw_re = re.compile('|'.join(map(re.escape, keywords)), re.I)
+        self._kw_bytes_re = re.compile(
+            b'|'.join(re.escape(w.encode()) for w in keywords), re.I
+        )
         self.GOOGLE_CSE_ID = os.getenv('GOOGLE_CSE_ID')
         self.GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 
         print(f"🔍 CSE_ID: {'✅' if self.GOOGLE_CSE_ID else '❌ MISSING'}")
         print(f"🔍 API_KEY: {'✅' if self.GOOGLE_API_KEY else '❌ MISSING'}")
 
-        self.site_css_paths = defaultdict(set)
-        self.site_contents = defaultdict(list)
-        self.site_positions = {}
-        self.all_sites = {}
+        self.sites = {}
         self.total_sites = 0
 
-    def get_css_path(self, elem):
-        """Generate COMPLETE CSS path from body to EXACT target element"""
-        try:
-            path = []
-            current = elem.root  
-            while current is not None:
-                tag = current.tag or 'div'
-                classes = current.get('class', '')
-                ids = current.get('id', '')
-                class_parts = []
-                for c in classes.split():
-                    if c.strip():
-                        class_parts.append(c.strip())
-                class_str = f".{'.'.join(class_parts)}" if class_parts else ""
-                id_str = f"#{ids}" if ids else ""
-
-                selector = f"{tag}{id_str}{class_str}"
-
-                path.append(selector)
-                current = current.getparent()
-
-                
-                if current is None or current.tag in ['html', 'body'] or len(path) > 50:
-                    break
-            full_path = " > ".join(reversed(path))
-            if not full_path.startswith(('body', 'html')):
-                full_path = f"body > {full_path}"
-
-            return full_path[:400]
-
-        except Exception as e:
-            self.logger.error(f"CSS path error: {e}")
-            return 'body > div'
+    def get_selector(self, node):
+        """Build the CSS selector for a single lxml element"""
+        ids = node.get('id')
+        classes = node.get('class', '').split()
+        return (
+            f"{node.tag or 'div'}"
+            f"{'#' + ids if ids else ''}"
+            f"{'.' + '.'.join(classes) if classes else ''}"
+        )
+
+    def get_css_path(self, elem, cache):
+        """Generate COMPLETE CSS path from body to EXACT target lxml element
+
+        cache maps elements of the current page to their path so shared
+        ancestor chains are only walked once per page.
+        """
+        if elem is None:
+            return 'body'
+
+        pending = []
+        parent_path = None
+        current = elem
+        while current is not None:
+            parent_path = cache.get(current)
+            if parent_path is not None:
+                break
+            pending.append(current)
+            current = current.getparent()
+
+            if current is None or current.tag in ['html', 'body']:
+                break
+
+        full_path = parent_path
+        for node in reversed(pending):
+            selector = self.get_selector(node)
+            full_path = f"{full_path} > {selector}" if full_path else selector
+            cache[node] = full_path
+
+        if not full_path.startswith(('body', 'html')):
+            full_path = f"body > {full_path}"
+
+        return full_path[:400]
 
     def start_requests(self):
         print("FORCING EXECUTION - NO DB CHECK!")
@@ -102,46 +152,71 @@ class KeywordTagSpider(scrapy.Spider):
             if self.total_sites >= 10:
                 break
             url = result.get('link')
-            if url:
+            if not url:
+                continue
+            site_key = canonicalize_url(url)
+            if site_key not in self.sites:
                 position = self.total_sites + 1
-                self.site_positions[url] = position
-                self.all_sites[url] = {'position': position, 'status': None}
+                self.sites[site_key] = SiteRecord(position=position)
                 self.total_sites += 1
                 yield scrapy.Request(
                     url=url,
                     callback=self.parse_tags,
-                    meta={'source_url': url, 'position': position}
+                    errback=self.handle_failed_request,
+                    meta={'source_url': url, 'site_key': site_key, 'position': position}
                 )
             
 
+    def body_has_keyword(self, response):
+        """Check for any keyword before lxml parses the page
+
+        The raw bytes are only searched when the page encoding stores the
+        keywords as plain ASCII; UTF-16/32 and similar fall back to the
+        decoded text.
+        """
+        if self.KEYWORD.encode(response.encoding) == self.KEYWORD.encode('ascii'):
+            return self._kw_bytes_re.search(response.body) is not None
+        return self._kw_re.search(response.text) is not None
+
     def parse_tags(self, response):
         source_url = response.meta['source_url']
         position = response.meta['position']
-        self.all_sites[source_url]['status'] = response.status
+        record = self.sites[response.meta['site_key']]
+        record.status = response.status
 
         print(f"Site #{position} ({source_url}): Status {response.status}")
 
-        if response.status >= 400:
-            self.logger.warning(f"⚠️ Site #{position} failed: {response.status}")
+        if not self.body_has_keyword(response):
             return
 
-        keywords = self.KEYWORD.lower().split()
-
-        for word in keywords:
-            xpath_query = (
-                f'//*[contains(translate(text(), "ABCDEFGHIJKLMNOPQRSTUVWXYZ", '
-                f'"abcdefghijklmnopqrstuvwxyz"), "{word}")]'
+        root = response.selector.root
+        css_cache = {}
+        seen_paths = record.css_paths
+
+        for elem in root.iter(etree.Element):
+            if elem.tag in SKIPPED_TAGS:
+                continue
+            text = first_text(elem)
+            if not text or not self._kw_re.search(text):
+                continue
+            css_path = self.get_css_path(elem, css_cache)
+            if css_path in seen_paths:
+                continue
+            seen_paths.add(css_path)
+
+            yield TagItem(
+                url=source_url,
+                position=position,
+                css_path=css_path,
             )
-            for elem in response.xpath(xpath_query):
-                css_path = self.get_css_path(elem)
-                yield {
-                    'url': source_url,
-                    'position': position, 
-                    'css_path': css_path,
-                }
 
-                self.site_css_paths[source_url].add(css_path)
+    def handle_failed_request(self, failure):
+        request = failure.request
+        position = request.meta['position']
+        if failure.check(HttpError):
+            self.sites[request.meta['site_key']].status = failure.value.response.status
+        self.logger.warning(f"⚠️ Site #{position} failed: {failure.getErrorMessage()}")
 
     def closed(self, reason):
         print(f"🎉 FINISHED: {self.total_sites} sites processed!")
-        print("💾 Check your output JSON for url, position, css_path!")
+        print("💾 Check your output feed (css_paths.jsonl.gz by default) for url, position, css_path!")